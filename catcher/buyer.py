@@ -1,15 +1,27 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 from functools import wraps
+from joblib import parallel_backend
 from dask_ml.linear_model import LogisticRegression
 from sklearn.model_selection import cross_validate
-from toads.eda import plot_time_series
-from toads.image import Img
 from toads.utils import conditional
 from .feature_extraction import min_price_for_profit, make_buy_features, calc_cross_profit
 
 
+def _price_to_float(price) -> float:
+    """Converts float32 price into float keeping its shortest representation, e.g. 123.45 instead of 123.4500045."""
+    return float(str(price))
+
+
+def _joblib_backend_name():
+    """Returns 'dask' if a Dask client is running, otherwise falls back to 'loky'."""
+    try:
+        from dask.distributed import get_client
+        get_client()
+    except (ImportError, ValueError):
+        return 'loky'
+    return 'dask'
+
+
 class Buyer:
     """Decision mechanism for buying recommendations."""
 
@@ -39,7 +51,7 @@ class Buyer:
         prices = data.open.rename('price')
 
         # Отдельно сохраним последнюю цену
-        current = data.close[-1]
+        current = _price_to_float(data['close'].iloc[-1])
         prt('Current price:', current, self.api.instrument.currency)
 
         # Сформировать обучающую выборку
@@ -70,7 +82,9 @@ class Buyer:
         if cross_val:
             try:
                 prt('Cross-validating...')
-                rocauc = np.mean(cross_validate(self.model, X, y, scoring='roc_auc', cv=3)['test_score'])
+                # Фолды независимы, поэтому обучаем их параллельно
+                with parallel_backend(_joblib_backend_name()):
+                    rocauc = np.mean(cross_validate(self.model, X, y, scoring='roc_auc', cv=3, n_jobs=-1)['test_score'])
                 prt(f'ROC AUC score: {rocauc:.3f}')
             except:
                 rocauc = None
@@ -103,12 +117,17 @@ class Buyer:
 
     def get_current_price(self):
         """Get current price from api."""
-        return self.api.get_stock_prices(interval='1min', periods=5).close[-1]
+        return _price_to_float(self.api.get_stock_prices(interval='1min', periods=5)['close'].iloc[-1])
 
     def make_chart(self, prices, current_price,
                    title=None, optional_feature=None,
                    no_show=False, save_to='img.png', **save_kws):
         """Draw a chart to visualize green zone and current situation."""
+        # Графические библиотеки импортируются только при отрисовке
+        import matplotlib.pyplot as plt
+        from toads.eda import plot_time_series
+        from toads.image import Img
+
         with Img(st=title, legend='f' if optional_feature is not None else 'a',
                  no_show=no_show) as img:
             # Зелёная зона - где продажа без убытка
@@ -126,6 +145,10 @@ class Buyer:
                 img.savefig(fname=save_to, **save_kws)
 
     def draw_feature_importances(self):
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        from toads.image import Img
+
         fi = None
         if hasattr(self.model, 'coef_'):
             fi = self.model.coef_[0]
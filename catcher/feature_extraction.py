@@ -1,13 +1,22 @@
 import pandas as pd
 import numpy as np
+from numba import njit, prange
+from pandas.api.indexers import FixedForwardWindowIndexer
+from scipy.signal import oaconvolve
+from scipy.signal.windows import bohman
 from .timeseries import future_periods
-from scipy.optimize import root
 
 
-def lookahead_window(column, aggfunc, window_size=60, shift=0, **agg_kws):
-    """Выполняет агрегирование столбца с забеганием вперёд."""
-    # Переворачиваем выборку, агрегируем и разворачиваем обратно
-    return column[::-1].shift(-shift).rolling(window_size, min_periods=1).agg(aggfunc, **agg_kws)[::-1]
+def lookahead_window(column, aggfunc, window_size=60, shift=0, raw=False, **agg_kws):
+    """Выполняет агрегирование столбца с забеганием вперёд.
+    Окно передаётся в хронологическом порядке: первый элемент - текущее значение, последний - самое дальнее.
+    При raw=True пользовательская функция получает окно как np.ndarray, а не как pd.Series."""
+    # Окно смотрит вперёд, поэтому разворачивать выборку не нужно
+    window = FixedForwardWindowIndexer(window_size=window_size)
+    rolling = column.shift(shift).rolling(window, min_periods=1)
+    if raw and callable(aggfunc):
+        return rolling.apply(aggfunc, raw=True, kwargs=agg_kws)
+    return rolling.agg(aggfunc, **agg_kws)
 
 
 def profit(buy_price: float,
@@ -42,26 +51,44 @@ def min_price_for_profit(buy_price, broker_commission=0.003) -> float:
     Returns:
         float
     """
-    return np.round(root(lambda sell: profit(buy_price=buy_price,
-                                             sell_price=sell,
-                                             threshold=0,
-                                             broker_commission=broker_commission),
-                         x0=buy_price)['x'][0],
-                    decimals=2)
-
-
-def generate_features(data, price_column, future=True, rolling_periods=60):
-    """Пайплайн для генерации признаков."""
+    # Решаем линейное уравнение sell - buy - (sell + buy) * commission = 0 относительно sell
+    min_price = buy_price * (1 + broker_commission) / (1 - broker_commission)
+    # Округляем вверх до копейки, погрешность деления не должна добавлять лишнюю копейку
+    cents = np.ceil(np.round(min_price * 100, 6)) / 100
+    # Если такое округление всё же дало убыток, берём следующую копейку
+    cents = cents + 0.01 * (profit(buy_price=buy_price, sell_price=cents, broker_commission=broker_commission) < 0)
+    return np.round(cents, decimals=2)
+
+
+def generate_features(data, price_column, future=True, rolling_periods=60, engine=None, engine_kwargs=None):
+    """Пайплайн для генерации признаков.
+    engine и engine_kwargs передаются в rolling().mean(). Для больших данных подходит
+    engine='numba', engine_kwargs={'nopython': True, 'nogil': True, 'parallel': True}."""
     df = data[[price_column]]
     # Отсчёт
     if future:
         df['future'] = future_periods(data)
     # Среднее
     if rolling_periods > 0:
-        df[f'rolling_avg_{rolling_periods}'] = data[price_column].rolling(rolling_periods, min_periods=1).mean()
+        df[f'rolling_avg_{rolling_periods}'] = data[price_column].rolling(rolling_periods, min_periods=1).mean(
+            engine=engine, engine_kwargs=engine_kwargs)
     return df
 
 
+def _weighted_rolling_mean(values, weights):
+    """Скользящее среднее с весами окна. Первые неполные окна и окна с пропусками заполняются пропусками."""
+    window = weights.shape[0]
+    result = np.full(values.shape[0], np.nan)
+    if window <= values.shape[0]:
+        # Свёртка через FFT не переносит пропуски, поэтому считаем их отдельно
+        nan_mask = np.isnan(values)
+        kernel = weights[::-1] / weights.sum()
+        result[window - 1:] = oaconvolve(np.where(nan_mask, 0, values), kernel, mode='valid')
+        has_nan = oaconvolve(nan_mask.astype(np.float64), np.ones(window), mode='valid') > 0.5
+        result[window - 1:][has_nan] = np.nan
+    return result
+
+
 def make_buy_features(data: pd.DataFrame,
                       price_column='open',
                       window_sizes=None,
@@ -76,11 +103,13 @@ def make_buy_features(data: pd.DataFrame,
     Returns:
         pd.DataFrame: data updated with generated features.
     """
-    features = data.copy()
+    prices = data[price_column].to_numpy(dtype=np.float64)
+    features = {}
 
     # Расширяющееся окно
-    expanding_mean = features[price_column].expanding().mean()
-    features['avg_deviation_exp'] = (features[price_column] - expanding_mean) / expanding_mean
+    not_nan = ~np.isnan(prices)
+    expanding_mean = np.nancumsum(prices) / np.cumsum(not_nan)
+    features['avg_deviation_exp'] = (prices - expanding_mean) / expanding_mean
 
     if window_sizes:
         try:
@@ -88,33 +117,32 @@ def make_buy_features(data: pd.DataFrame,
         except TypeError:
             raise TypeError('window_sizes variable must be iterable.')
         for window in window_sizes:
-            # Средние
-            features[f'rolling_avg_{window}'] = (features[price_column]
-                                                 .shift(-(window // 2) * shift_windows)
-                                                 .rolling(window, win_type='bohman')
-                                                 .mean())
+            # Средние со сдвигом назад во времени
+            shift = window // 2 * shift_windows
+            shifted = np.concatenate([prices[shift:], np.full(min(shift, prices.shape[0]), np.nan)])
+            rolling_avg = _weighted_rolling_mean(shifted, bohman(window))
 
             # Отклонение от среднего в процентах
-            features[f'avg_deviation_{window}'] = (features[price_column] - features[f'rolling_avg_{window}']) / \
-                                                  features[
-                                                      f'rolling_avg_{window}']
-
-            # Создаём окно
-            rolling = features[price_column].rolling(window)
+            features[f'avg_deviation_{window}'] = (prices - rolling_avg) / rolling_avg
 
-        # Отбрасываем скользящее среднее
-        features.drop([col for col in features.columns if 'roll' in col and 'diff' not in col], axis=1, inplace=True)
+    # Собираем таблицу один раз и отбрасываем хвост с пропусками
+    return data.assign(**features).dropna()
 
-    # Отбрасываем хвост с пропусками
-    features.dropna(inplace=True)
 
-    return features
+@njit(parallel=True, cache=True)
+def _cross_profit_kernel(prices, buy_idx, sell_idx, broker_commission, threshold, out):
+    """Fills out[k] with the fact of profit for buying at prices[buy_idx[k]] and selling at prices[sell_idx[k]]."""
+    for k in prange(buy_idx.shape[0]):
+        buy = prices[buy_idx[k]]
+        sell = prices[sell_idx[k]]
+        out[k] = (sell - buy - (sell + buy) * broker_commission) / buy >= threshold
 
 
 def calc_cross_profit(data: pd.DataFrame, price_col='open', policy='lookahead', broker_commission=0.003,
                       profit_threshold=0):
     """Calculates profit cases for each combination of known buy and sell prices.
     Use after all the other features had been generated. Data must contain column with price values.
+    Rows are sorted by time before pairing, so the result follows chronological order.
 
     Args:
         data (pd.DataFrame): Data to generate profit column.
@@ -133,42 +161,38 @@ def calc_cross_profit(data: pd.DataFrame, price_col='open', policy='lookahead',
     # Индекс обязательно должен быть datetime
     assert isinstance(data.index, pd.DatetimeIndex), 'Index must be of type pd.DateTimeIndex.'
 
-    # И называться 'datetime'
-    dt_str = 'datetime'
-
-    # Автоматически переименовываем, если индекс не 'datetime'
-    if data.index.name != dt_str:
-        data.index.name = dt_str
+    # Цены должны идти в хронологическом порядке, чтобы треугольники матрицы совпадали с будущим и прошлым
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='stable')
 
-    # Создадим вспомогательный датафрейм для внутренней работы
-    df = data.reset_index()
+    prices = data[price_col].to_numpy()
+    n = prices.shape[0]
 
-    # Соединим каждую цену покупки с каждой ценой продажи
-    data_cross = df.join(df[[price_col, dt_str]], how='cross', rsuffix='_sell')
+    assert profit_threshold >= 0, 'Negative threshold will lead to money loss. Change it for at least zero value.'
 
-    # Создадим признак-маркер будущего
-    future = data_cross.datetime_sell > data_cross.datetime
-    # Оставим только те строки, где цена продажи находится в будущем, если 'lookahead' или стратегия не задана
+    # Оставим только те пары, где цена продажи находится в будущем, если 'lookahead' или стратегия не задана
     if policy in ('lookahead', 'la') or not policy:
-        data_cross = data_cross.loc[future]  # Дата покупки меньше даты продажи
+        buy_idx, sell_idx = np.triu_indices(n, k=1)  # Дата покупки меньше даты продажи
     elif policy in ('lookbehind', 'lb'):
-        data_cross = data_cross.loc[~future]  # Дата покупки меньше даты продажи
-    elif policy in ('full', 'lookaround', 'lar'):
-        data_cross['future'] = future.astype('int')
-
-    # Посчитаем отсутствие убытков в каждом случае
-    cross_profit = profit(buy_price=data_cross[price_col].values,
-                          sell_price=data_cross[price_col + '_sell'].values,
-                          broker_commission=broker_commission,
-                          threshold=profit_threshold).astype('int8')
-
-    return data_cross.set_index(  # Вернём на место индекс со временем
-        'datetime'
-    ).drop(  # Удалим столбцы с данными о продаже
-        columns=[col for col in data_cross.columns if col.endswith('_sell')]
-    ).assign(  # Добавим столбец с целевым признаком
-        profit=cross_profit
-    )
+        buy_idx, sell_idx = np.tril_indices(n)  # Дата покупки не меньше даты продажи
+    else:
+        buy_idx, sell_idx = (idx.ravel() for idx in np.indices((n, n)))
+
+    # Прибыльность считаем только для оставленных пар за один проход без промежуточных массивов
+    cross_profit = np.empty(buy_idx.shape[0], dtype=np.int8)
+    _cross_profit_kernel(prices.astype(np.float64), buy_idx, sell_idx,
+                         broker_commission, profit_threshold / 100, cross_profit)
+
+    # Размножим строки покупок по позициям, не трогая индекс со временем
+    columns = {col: data[col].to_numpy()[buy_idx] for col in data.columns}
+
+    # Создадим признак-маркер будущего
+    if policy in ('full', 'lookaround', 'lar'):
+        columns['future'] = (sell_idx > buy_idx).astype('int')
+
+    # Добавим столбец с целевым признаком и соберём таблицу один раз
+    columns['profit'] = cross_profit
+    return pd.DataFrame(columns, index=pd.DatetimeIndex(data.index.to_numpy()[buy_idx], name='datetime'), copy=False)
 
 
 __all__ = ['lookahead_window',
@@ -1,25 +1,33 @@
 import json
+import os
 import pandas as pd
 
 
 def json_write_results(d: dict, file: str):
-    """TODO"""
-    try:
-        with open(file, 'r+') as f:
-            origin = json.load(f)
-            assert isinstance(origin, list), 'Original file is not iterable.'
-            f.seek(0)
-            json.dump(origin + [d], f)
-    except FileNotFoundError:
+    """Дописывает результат в конец файла в формате JSON Lines."""
+    if not os.path.exists(file):
         print('Creating new file', file)
-        with open(file, 'w') as file:
-            json.dump([d], file)
+    else:
+        # Дописывание в файл старого формата испортит его для обоих форматов
+        with open(file) as f:
+            if f.read(1) == '[':
+                raise ValueError(f'File {file} is in legacy list format. Convert it with json_migrate_results first.')
+    with open(file, 'a') as f:
+        f.write(json.dumps(d) + '\n')
 
 
 def json_load_results(file):
-    """TODO"""
-    with open(file) as file:
-        return pd.DataFrame(json.load(file)).drop_duplicates()
+    """Загружает результаты из файла в формате JSON Lines."""
+    return pd.read_json(file, lines=True, dtype=False, convert_dates=False).drop_duplicates()
 
 
-__all__ = ['json_write_results', 'json_load_results']
+def json_migrate_results(file):
+    """Переводит файл со старым форматом (один JSON-список) в формат JSON Lines."""
+    with open(file) as f:
+        origin = json.load(f)
+    assert isinstance(origin, list), 'Original file is not iterable.'
+    with open(file, 'w') as f:
+        f.writelines(json.dumps(d) + '\n' for d in origin)
+
+
+__all__ = ['json_write_results', 'json_load_results', 'json_migrate_results']
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import datetime
 from statsmodels.tsa.stattools import adfuller
@@ -10,17 +11,18 @@ def check_stationary(time_series) -> bool:
 
 def last_day(data):
     """Выбирает последний день из данных."""
-    last_date = data.index[-1]
-    return data.loc[(data.index.day == last_date.day) & (data.index.year == last_date.year)].copy()
+    # Индекс отсортирован по времени, поэтому последний день - это хвост таблицы
+    day_start = data.index[-1].normalize()
+    return data.iloc[data.index.searchsorted(day_start, side='left'):].copy()
 
 
 def working_hours(data, datetime_col=None, weekend_days=(5, 6)):
     """Оставляет только будние дни. По умолчанию использует индекс в качестве столбца с датой."""
-    if not datetime_col:
-        datetime_col = data.dropna().index
-    return data.dropna()[(~datetime_col.dayofweek.isin(weekend_days)) &
-                (datetime_col.hour.min() <= datetime_col.hour) &
-                (datetime_col.hour <= datetime_col.hour.max())]
+    data = data.dropna()
+    if datetime_col is None:
+        datetime_col = data.index
+    # Границы часов берутся из тех же данных, поэтому по часам ничего не отсекается
+    return data[~np.isin(datetime_col.dayofweek, weekend_days)]
 
 
 def split_day(data, split_hour=13):
@@ -30,7 +32,7 @@ def split_day(data, split_hour=13):
 
 def future_periods(data):
     """Обратный отсчёт. Показывает, сколько осталось времени до конца торгов."""
-    return pd.Series(data=range(data.shape[0] - 1, -1, -1), index=data.index)
+    return pd.Series(data=np.arange(data.shape[0] - 1, -1, -1, dtype=np.int64), index=data.index)
 
 
 def datetime_append(date=None, hours=15, minutes=59) -> pd.Timestamp:
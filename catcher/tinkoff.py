@@ -1,28 +1,61 @@
 import datetime
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
+import numpy as np
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-def check_response(r):
-    """Проверяет код ответа от API и возвращает JSON."""
-    assert r.status_code == 200, r.json()['payload']['message']
-    return r.json()
+# Типы столбцов свечей. float32 вдвое сокращает память под цены во всех последующих расчётах,
+# объём остаётся int64: на дневных и более длинных свечах он может превышать 2^31
+CANDLE_DTYPES = {'open': np.float32,
+                 'close': np.float32,
+                 'high': np.float32,
+                 'low': np.float32,
+                 'volume': np.int64}
+
+# pandas 2 выводит формат времени по первому элементу, поэтому для смешанной точности ISO 8601 задаём явно.
+# В pandas 1.x 'ISO8601' читается как шаблон strftime, а разбор смешанных форматов работает и без него
+_TIME_FORMAT_KWS = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
 
 
-def preproc_pipeline(df) -> pd.DataFrame:
-    """Пайплайн предобработки цен на акции."""
-    if df.shape[0] == 0:
-        return df
-    return df.assign(
-        datetime=pd.to_datetime(df.time).dt.tz_localize(None) + pd.Timedelta('3h')
-    ).drop(['interval', 'figi', 'time'],
-           axis=1).set_index('datetime').rename(columns={'o': 'open',
-                                                         'c': 'close',
-                                                         'h': 'high',
-                                                         'l': 'low',
-                                                         'v': 'volume'})
+def check_response(r):
+    """Проверяет код ответа от API и возвращает JSON."""
+    # JSON разбирается ровно один раз, в том числе для ответа с ошибкой
+    try:
+        payload = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        if r.status_code != 200:
+            raise RuntimeError(r.text)
+        raise
+    if r.status_code != 200:
+        try:
+            message = payload['payload']['message']
+        except (KeyError, TypeError):
+            message = r.text
+        raise RuntimeError(message)
+    return payload
+
+
+def preproc_pipeline(candles) -> pd.DataFrame:
+    """Пайплайн предобработки цен на акции. Принимает список свечей из ответа API или таблицу с ними."""
+    # Поддерживаем и прежний вход - таблицу со свечами
+    if isinstance(candles, pd.DataFrame):
+        candles = candles.to_dict('records')
+
+    # Столбцы собираются напрямую из свечей, без промежуточной таблицы из словарей
+    n = len(candles)
+    columns = {name: np.fromiter((candle[key] for candle in candles), dtype=CANDLE_DTYPES[name], count=n)
+               for key, name in (('o', 'open'), ('c', 'close'), ('h', 'high'), ('l', 'low'), ('v', 'volume'))}
+    # Время приходит в ISO 8601 с разной точностью и смещением, приводим к UTC и сдвигаем в московское
+    datetime_index = (pd.to_datetime([candle['time'] for candle in candles], utc=True, **_TIME_FORMAT_KWS)
+                      .tz_convert(None) + pd.Timedelta('3h'))
+    return pd.DataFrame(columns, index=pd.DatetimeIndex(datetime_index, name='datetime'), copy=False)
 
 
 def make_datetime(time: str = None):
@@ -43,28 +76,32 @@ class TinkoffAPI:
     default_ticker = 'tcsg'
     Instrument = namedtuple('Instrument', 'figi ticker isin minPriceIncrement lot currency name type')
 
-    # Таблица временных интервалов и их границ
-    TIME_INTERVALS = pd.DataFrame(
-        index=['1min', '2min', '3min', '5min', '10min', '15min', '30min', 'hour', 'day', 'week', 'month'],
-        data={
-            'max_length': map(pd.Timedelta, ['1d', '1d', '1d', '1d', '1d', '1d', '1d', '7d', '365d', '104w', '3650d']),
-            'timedelta': map(pd.Timedelta,
-                             ['1min', '2min', '3min', '5min', '10min', '15min', '30min', '1h', '1d', '1w', '30d'])}
-    )
+    # Максимальная длина запроса для каждого временного интервала
+    TIME_INTERVALS_MAX = dict(zip(
+        ['1min', '2min', '3min', '5min', '10min', '15min', '30min', 'hour', 'day', 'week', 'month'],
+        map(pd.Timedelta, ['1d', '1d', '1d', '1d', '1d', '1d', '1d', '7d', '365d', '104w', '3650d'])
+    ))
+
+    # Длина одной свечи для каждого временного интервала
+    TIME_INTERVALS_DELTA = dict(zip(
+        TIME_INTERVALS_MAX,
+        map(pd.Timedelta, ['1min', '2min', '3min', '5min', '10min', '15min', '30min', '1h', '1d', '1w', '30d'])
+    ))
+
+    # Таблица временных интервалов и их границ для справки
+    TIME_INTERVALS = pd.DataFrame({'max_length': TIME_INTERVALS_MAX, 'timedelta': TIME_INTERVALS_DELTA})
 
     def register_sandbox(self):
         """Регистрирует аккаунт в песочнице."""
-        r = requests.post('https://api-invest.tinkoff.ru/openapi/sandbox/sandbox/register',
-                          params={'brokerAccountType': 'Tinkoff'},
-                          headers=self.header)
+        r = self.session.post('https://api-invest.tinkoff.ru/openapi/sandbox/sandbox/register',
+                              params={'brokerAccountType': 'Tinkoff'})
         self.account_id = check_response(r)['payload']['brokerAccountId']
         print('Sandbox account ID:', self.account_id)
 
     def remove_sandbox(self):
         """Удаляет аккаунт из песочницы."""
-        r = requests.post('https://api-invest.tinkoff.ru/openapi/sandbox/sandbox/remove',
-                          params={'brokerAccountId': self.account_id},
-                          headers=self.header)
+        r = self.session.post('https://api-invest.tinkoff.ru/openapi/sandbox/sandbox/remove',
+                              params={'brokerAccountId': self.account_id})
         check_response(r)
         print(f'Account "{self.account_id}" successfully removed.')
 
@@ -81,7 +118,7 @@ class TinkoffAPI:
         Raises:
             AssertionError: when time interval is invalid.
         '''
-        assert interval in TinkoffAPI.TIME_INTERVALS.index, f'Wrong time interval "{interval}". Accepted values are {TinkoffAPI.TIME_INTERVALS.index}.'
+        assert interval in TinkoffAPI.TIME_INTERVALS_MAX, f'Wrong time interval "{interval}". Accepted values are {list(TinkoffAPI.TIME_INTERVALS_MAX)}.'
 
     def get_stock_prices(self, date=None, periods=None, batches: int = 1, ticker=None, interval='1min',
                          preprocess=preproc_pipeline):
@@ -92,45 +129,45 @@ class TinkoffAPI:
             periods (int, optional): number of most recent periods available from selected date back.
             batches (int, optional): number of full consequent batches of data downloaded
             ticker (str, optional):  ticker to load data on.
-            interval (str, optional): time window to aggregate stocks data. Available intervals are contained in TinkoffAPI.TIME_INTERVALS table.
-            preprocess (func) - function that preprocesses data into desired form."""
+            interval (str, optional): time window to aggregate stocks data. Available intervals are contained in TinkoffAPI.TIME_INTERVALS_MAX.
+            preprocess (func) - function that turns the list of raw candle dicts into desired form."""
         # Проверяем валидность интервала
         TinkoffAPI.check_time_interval(interval)
 
-        data = []
-
         # Дельта во времени, если есть
-        batch_length = (TinkoffAPI.TIME_INTERVALS.at[interval, 'timedelta'] * periods if periods
-                        else TinkoffAPI.TIME_INTERVALS.at[interval, 'max_length'])
-
-        # Батчи идут задом наперёд, чтобы скачивать данные в хронологическом порядке
-        for batch_n in range(batches, 0, -1):
-            # Инициализируем время в datetime
-            if not date:
-                dt = make_datetime()
-            else:
-                dt = make_datetime(date) + datetime.timedelta(days=1)
-
-            # Время начала раньше времени конца на 1 батч
-            start_date = strftime(dt - batch_length * (batch_n))
-
-            # С каждым батчем время вычитается на 1 batch_length
-            end_date = strftime(dt - batch_length * (batch_n - 1))
-
-            #             print('from {} to {}'.format(start_date, end_date))
-
-            # Делаем запрос
-            r = requests.get('https://api-invest.tinkoff.ru/openapi/sandbox/market/candles',
-                             params={'figi': self.get_figi_by_ticker(ticker=ticker) if ticker else self.instrument.figi,
-                                     'from': start_date,
-                                     'to': end_date,
-                                     'interval': interval},
-                             headers=self.header)
-            # Пополняем список очередным батчем
-            data.append(
-                preprocess(pd.DataFrame(check_response(r)['payload']['candles']))
-            )
-        return pd.concat(data)
+        batch_length = (TinkoffAPI.TIME_INTERVALS_DELTA[interval] * periods if periods
+                        else TinkoffAPI.TIME_INTERVALS_MAX[interval])
+
+        # Инициализируем время в datetime
+        if not date:
+            dt = make_datetime()
+        else:
+            dt = make_datetime(date) + datetime.timedelta(days=1)
+
+        # FIGI не меняется между батчами, поэтому определяем его один раз
+        figi = self.get_figi_by_ticker(ticker=ticker) if ticker else self.instrument.figi
+
+        # Батчи идут задом наперёд, чтобы скачивать данные в хронологическом порядке.
+        # Время начала раньше времени конца на 1 батч, с каждым батчем время вычитается на 1 batch_length
+        bounds = [(strftime(dt - batch_length * batch_n), strftime(dt - batch_length * (batch_n - 1)))
+                  for batch_n in range(batches, 0, -1)]
+
+        def load_batch(start_end):
+            """Скачивает сырые свечи одного батча."""
+            start_date, end_date = start_end
+            r = self.session.get('https://api-invest.tinkoff.ru/openapi/sandbox/market/candles',
+                                 params={'figi': figi,
+                                         'from': start_date,
+                                         'to': end_date,
+                                         'interval': interval})
+            return check_response(r)['payload']['candles']
+
+        # Батчи независимы, поэтому качаем их параллельно. map сохраняет хронологический порядок
+        with ThreadPoolExecutor(max_workers=min(batches, 8)) as executor:
+            candles = list(chain.from_iterable(executor.map(load_batch, bounds)))
+
+        # Предобработка выполняется один раз для всех батчей сразу
+        return preprocess(candles)
 
     def get_instrument_by_ticker(self, ticker=None):
         """Получает инструмент по тикеру.
@@ -141,10 +178,13 @@ class TinkoffAPI:
         Returns:
             Instrument: namedtuple object containing info about market instrument.
         """
-        r = requests.get('https://api-invest.tinkoff.ru/openapi/sandbox/market/search/by-ticker',
-                         params={'ticker': ticker if ticker else self.instrument.ticker},
-                         headers=self.header)
-        return TinkoffAPI.Instrument(**check_response(r)['payload']['instruments'][0])
+        ticker = ticker if ticker else self.instrument.ticker
+        # Инструмент не меняется за время работы, поэтому запоминаем его в контексте
+        if ticker not in self._instruments:
+            r = self.session.get('https://api-invest.tinkoff.ru/openapi/sandbox/market/search/by-ticker',
+                                 params={'ticker': ticker})
+            self._instruments[ticker] = TinkoffAPI.Instrument(**check_response(r)['payload']['instruments'][0])
+        return self._instruments[ticker]
 
     def get_figi_by_ticker(self, ticker=None):
         """Получает FIGI инструмента."""
@@ -159,7 +199,15 @@ class TinkoffAPI:
             self.token = token
 
         self.header = {'Authorization': f'Bearer {self.token}'}
+
+        # Одна сессия на контекст, чтобы переиспользовать соединения с API
+        self.session = requests.Session()
+        self.session.headers.update(self.header)
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+
         self.account_id = None
+        self._instruments = {}
         self.instrument = self.get_instrument_by_ticker(ticker)
         print('Selected instrument: {name}.'.format(name=self.instrument.name))
 
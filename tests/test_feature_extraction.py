@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from catcher.feature_extraction import min_price_for_profit, profit
+
+
+@pytest.mark.parametrize('broker_commission', [0, 0.0005, 0.003, 0.01])
+def test_min_price_for_profit_is_non_loss(broker_commission):
+    for buy_price in np.round(np.arange(0.01, 5000, 0.37), 2):
+        min_price = min_price_for_profit(buy_price, broker_commission=broker_commission)
+        assert profit(buy_price, min_price, broker_commission=broker_commission) >= 0
+        assert min_price == round(min_price, 2)
+
+
+def test_min_price_for_profit_is_rounded_up_to_cent():
+    assert min_price_for_profit(100) == pytest.approx(100.61)
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from catcher.tinkoff import preproc_pipeline
+
+
+def make_candle(time, volume=10):
+    return {'o': 1.5, 'c': 2, 'h': 3, 'l': 1, 'v': volume, 'time': time, 'interval': '1min', 'figi': 'FIGI'}
+
+
+def test_preproc_pipeline_parses_mixed_timestamps():
+    candles = [make_candle('2021-06-21T07:00:00Z'), make_candle('2021-06-21T10:01:00.5+03:00')]
+    data = preproc_pipeline(candles)
+    assert list(data.index) == [pd.Timestamp('2021-06-21 10:00:00'), pd.Timestamp('2021-06-21 10:01:00.5')]
+    assert data.index.name == 'datetime'
+
+
+def test_preproc_pipeline_keeps_large_volume():
+    data = preproc_pipeline([make_candle('2021-06-21T07:00:00Z', volume=5_000_000_000)])
+    assert data.volume.dtype == np.int64
+    assert data.volume.iloc[0] == 5_000_000_000
+
+
+def test_preproc_pipeline_accepts_dataframe():
+    candles = [make_candle('2021-06-21T07:00:00Z'), make_candle('2021-06-21T07:01:00Z')]
+    pd.testing.assert_frame_equal(preproc_pipeline(pd.DataFrame(candles)), preproc_pipeline(candles))